@@ -1,16 +1,50 @@
+import fcntl
 import logging
+import os
+import struct
 from typing import Sequence, cast
 
 import evdev
 from evdev import UInput, AbsInfo
 
 from hhd.controller import Axis, Button, Consumer, Producer
-from hhd.controller.base import Event, can_read
+from hhd.controller.base import Event
 
 from .const import *
 
 logger = logging.getLogger(__name__)
 
+# Resolve event codes once, they are used for every event
+EV_SYN = evdev.ecodes.EV_SYN
+EV_KEY = evdev.ecodes.EV_KEY
+EV_ABS = evdev.ecodes.EV_ABS
+EV_MSC = evdev.ecodes.EV_MSC
+EV_FF = evdev.ecodes.EV_FF
+EV_UINPUT = evdev.ecodes.EV_UINPUT
+SYN_REPORT = evdev.ecodes.SYN_REPORT
+MSC_TIMESTAMP = evdev.ecodes.MSC_TIMESTAMP
+UI_FF_UPLOAD = evdev.ecodes.UI_FF_UPLOAD
+UI_FF_ERASE = evdev.ecodes.UI_FF_ERASE
+FF_RUMBLE = evdev.ecodes.FF_RUMBLE
+
+# Consumers treat events as read-only, so the stop event can be shared
+_RUMBLE_STOP: Event = {
+    "type": "rumble",
+    "code": "main",
+    "weak_magnitude": 0,
+    "strong_magnitude": 0,
+}
+
+# struct input_event: timeval (sec, usec), type, code, value.
+# The kernel stamps uinput events itself, so the time is left as 0.
+_IE = struct.Struct("llHHi")
+_SYN_REPORT = _IE.pack(0, 0, EV_SYN, SYN_REPORT, 0)
+
+# struct uinput_ff_erase: request_id, retval, effect_id.
+# UI_END_FF_ERASE = _IOW(UINPUT_IOCTL_BASE, 203, struct uinput_ff_erase)
+_FF_ERASE = struct.Struct("IiI")
+_UI_END_FF_ERASE = (1 << 30) | (_FF_ERASE.size << 16) | (ord("U") << 8) | 203
+
 
 class UInputDevice(Consumer, Producer):
     def __init__(
@@ -33,11 +67,38 @@ class UInputDevice(Consumer, Producer):
         self.pid = pid
         self.phys = phys
         self.output_timestamps = output_timestamps
-        self.ofs = 0
-        self.sys_ofs = 0
 
         self.rumble: Event | None = None
 
+        # Merge both maps into a single table so consume does one lookup
+        # per event. Keyed by (type, code), since e.g. "lt" is both an
+        # axis and a button.
+        self._dispatch: dict[
+            tuple[str, str], tuple[int, int, float, float, int, int]
+        ] = {}
+        for code, ax in axis_map.items():
+            lo, hi = ax.bounds or (-(2**31), 2**31 - 1)
+            # Axis values arrive normalized as floats, so keep the math in
+            # floats and avoid an int -> float promotion per event.
+            self._dispatch[("axis", code)] = (
+                EV_ABS,
+                ax.id,
+                float(ax.scale),
+                float(ax.offset),
+                lo,
+                hi,
+            )
+        for code, btn in btn_map.items():
+            self._dispatch[("button", code)] = (EV_KEY, btn, 1, 0, 0, 1)
+
+        # Resolve the timestamp setting here, so consume only does a set
+        # lookup (against an empty set if timestamps are disabled).
+        self._ts_keys: frozenset[tuple[str, str]] = (
+            frozenset({("axis", "accel_ts"), ("axis", "gyro_ts")})
+            if output_timestamps
+            else frozenset()
+        )
+
     def open(self) -> Sequence[int]:
         logger.info(f"Opening virtual device '{self.name}'.")
         self.dev = UInput(
@@ -60,36 +121,29 @@ class UInputDevice(Consumer, Producer):
     def consume(self, events: Sequence[Event]):
         if not self.dev:
             return
+        dispatch = self._dispatch
+        ts_keys = self._ts_keys
+        pack = _IE.pack
+        # Submit all events and the SYN_REPORT with a single write
+        buf = []
+        write = buf.append
         for ev in events:
-            match ev["type"]:
-                case "axis":
-                    if ev["code"] in self.axis_map:
-                        ax = self.axis_map[ev["code"]]
-                        val = int(ax.scale * ev["value"] + ax.offset)
-                        if ax.bounds:
-                            val = min(max(val, ax.bounds[0]), ax.bounds[1])
-                        self.dev.write(B("EV_ABS"), ax.id, val)
-                    elif self.output_timestamps and ev["code"] in (
-                        "accel_ts",
-                        "gyro_ts",
-                    ):
-                        # We have timestamps with ns accuracy.
-                        # Evdev expects us accuracy
-                        ts = ev["value"] // 1000
-                        # Use an ofs to avoid overflowing
-                        if ts > self.ofs + 2**30:
-                            self.ofs = ts
-                        ts -= self.ofs
-                        self.dev.write(B("EV_MSC"), B("MSC_TIMESTAMP"), ts)
-                        pass
-                case "button":
-                    if ev["code"] in self.btn_map:
-                        self.dev.write(
-                            B("EV_KEY"),
-                            self.btn_map[ev["code"]],
-                            1 if ev["value"] else 0,
-                        )
-        self.dev.syn()
+            key = (ev["type"], ev["code"])
+            d = dispatch.get(key)
+            if d:
+                t, cid, s, o, lo, hi = d
+                write(pack(0, 0, t, cid, min(max(int(s * ev["value"] + o), lo), hi)))
+            elif key in ts_keys:
+                # We have timestamps with ns accuracy.
+                # Evdev expects us accuracy. Drivers keep a u32 counter that
+                # is reinterpreted as the s32 event value, so wrap to 32 bits
+                ts = ((ev["value"] // 1000 + 2**31) & 0xFFFFFFFF) - 2**31
+                write(pack(0, 0, EV_MSC, MSC_TIMESTAMP, ts))
+        # Avoid waking up readers with an empty report
+        if not buf:
+            return
+        write(_SYN_REPORT)
+        os.write(self.dev.fd, b"".join(buf))
 
     def produce(self, fds: Sequence[int]) -> Sequence[Event]:
         if not self.fd or not self.fd in fds or not self.dev:
@@ -97,48 +151,52 @@ class UInputDevice(Consumer, Producer):
 
         out: Sequence[Event] = []
 
-        while can_read(self.fd):
-            for ev in self.dev.read():
-                if ev.type == B("EV_MSC") and ev.code == B("MSC_TIMESTAMP"):
-                    # Skip timestamp feedback
-                    # TODO: Figure out why it feedbacks
-                    pass
-                elif ev.type == B("EV_UINPUT"):
-                    if ev.code == B("UI_FF_UPLOAD"):
-                        # Keep uploaded effect to apply on input
-                        upload = self.dev.begin_upload(ev.value)
-                        if upload.effect.type == B("FF_RUMBLE"):
-                            data = upload.effect.u.ff_rumble_effect
-
-                            self.rumble = {
-                                "type": "rumble",
-                                "code": "main",
-                                "weak_magnitude": data.weak_magnitude / 0xFFFF,
-                                "strong_magnitude": data.strong_magnitude / 0xFFFF,
-                            }
-                        self.dev.end_upload(upload)
-                    elif ev.code == B("UI_FF_ERASE"):
-                        # Ignore erase events
-                        erase = self.dev.begin_erase(ev.value)
-                        erase.retval = 0
-                        ev.end_erase(erase)
-                elif ev.type == B("EV_FF") and ev.value:
-                    if self.rumble:
-                        out.append(self.rumble)
-                    else:
-                        logger.warn(
-                            f"Rumble requested but a rumble effect has not been uploaded."
-                        )
-                elif ev.type == B("EV_FF") and not ev.value:
-                    out.append(
-                        {
+        # Read a batch directly instead of checking readiness first.
+        # Callers may invoke produce on every wakeup, even when our fd is
+        # not readable (e.g., the legion go shortcuts loop). The fd is
+        # non-blocking, so those spurious calls end up in BlockingIOError.
+        # Events are unpacked from the raw buffer, avoiding an evdev
+        # InputEvent object per event.
+        try:
+            buf = os.read(self.fd, _IE.size * 64)
+        except BlockingIOError:
+            return out
+
+        for _, _, t, c, v in _IE.iter_unpack(buf):
+            if t == EV_MSC and c == MSC_TIMESTAMP:
+                # Skip timestamp feedback
+                # TODO: Figure out why it feedbacks
+                pass
+            elif t == EV_UINPUT:
+                if c == UI_FF_UPLOAD:
+                    # Keep uploaded effect to apply on input
+                    upload = self.dev.begin_upload(v)
+                    if upload.effect.type == FF_RUMBLE:
+                        data = upload.effect.u.ff_rumble_effect
+
+                        self.rumble = {
                             "type": "rumble",
                             "code": "main",
-                            "weak_magnitude": 0,
-                            "strong_magnitude": 0,
+                            "weak_magnitude": data.weak_magnitude / 0xFFFF,
+                            "strong_magnitude": data.strong_magnitude / 0xFFFF,
                         }
-                    )
+                    self.dev.end_upload(upload)
+                elif c == UI_FF_ERASE:
+                    # Ignore erase events, the kernel only needs the
+                    # request acknowledged so skip UI_BEGIN_FF_ERASE
+                    fcntl.ioctl(self.fd, _UI_END_FF_ERASE, _FF_ERASE.pack(v, 0, 0))
+            elif t == EV_FF and v:
+                if self.rumble:
+                    out.append(self.rumble)
                 else:
-                    logger.info(f"Controller ev received unhandled event:\n{ev}")
+                    logger.warn(
+                        f"Rumble requested but a rumble effect has not been uploaded."
+                    )
+            elif t == EV_FF and not v:
+                out.append(_RUMBLE_STOP)
+            else:
+                logger.info(
+                    f"Controller ev received unhandled event: type {t}, code {c}, value {v}"
+                )
 
         return out
@@ -1,13 +1,12 @@
 import logging
 import os
 import select
+import stat
 import subprocess
 from threading import Event
 from time import perf_counter, sleep
-from typing import cast
 
 import evdev
-from evdev import ecodes as e
 
 from hhd.utils import Context, expanduser
 
@@ -17,37 +16,151 @@ logger = logging.getLogger(__name__)
 
 STEAM_PID = "~/.steam/steam.pid"
 STEAM_EXE = "~/.steam/root/ubuntu12_32/steam"
+STEAM_DIR = "~/.steam"
+STEAM_PIPE = "steam.pipe"
 STEAM_WAIT_DELAY = 0.5
 LONG_PRESS_DELAY = 2.5
 
+EV_KEY = evdev.ecodes.EV_KEY
+KEY_POWER = evdev.ecodes.KEY_POWER
 
-def B(b: str):
-    return cast(int, getattr(evdev.ecodes, b))
+_BY_PROD = {d.prod_name: d for d in SUPPORTED_DEVICES}
+
+
+# Steam's pid and launch mode only change when it restarts, so the last
+# answer is kept until either the pid file or the process changes.
+_steam_cache = {
+    "pid_path": None,
+    "pid_mtime": 0.0,
+    "proc_ctime": 0.0,
+    "pid": None,
+    "answer": False,
+}
+
+
+def is_process_alive(pid: str):
+    # Exited processes keep their /proc entry until reaped, check the
+    # state field to tell zombies apart. comm may contain parentheses.
+    with open(f"/proc/{pid}/stat", "rb") as f:
+        state = f.read().rsplit(b")", 1)[1].split(maxsplit=1)[0]
+    return state not in (b"Z", b"X")
 
 
 def is_steam_gamescope_running(ctx: Context):
-    pid = None
+    c = _steam_cache
     try:
-        with open(expanduser(STEAM_PID, ctx)) as f:
+        pid_path = expanduser(STEAM_PID, ctx)
+        pid_mtime = os.stat(pid_path).st_mtime
+        if (
+            c["pid"]
+            and c["pid_path"] == pid_path
+            and c["pid_mtime"] == pid_mtime
+            and os.stat(f"/proc/{c['pid']}").st_ctime == c["proc_ctime"]
+            and is_process_alive(c["pid"])
+        ):
+            return c["answer"]
+
+        c["pid"] = None
+        with open(pid_path) as f:
             pid = f.read().strip()
 
         steam_cmd_path = f"/proc/{pid}/cmdline"
         if not os.path.exists(steam_cmd_path):
             return False
+        proc_ctime = os.stat(f"/proc/{pid}").st_ctime
 
         # Use this and line to determine if Steam is running in DeckUI mode.
         with open(steam_cmd_path, "rb") as f:
             steam_cmd = f.read()
         is_deck_ui = b"-gamepadui" in steam_cmd
-        if not is_deck_ui:
-            return False
+
+        c.update(
+            pid_path=pid_path,
+            pid_mtime=pid_mtime,
+            proc_ctime=proc_ctime,
+            pid=pid,
+            answer=is_deck_ui,
+        )
+        return is_deck_ui
     except Exception as e:
+        c["pid"] = None
         return False
-    return True
+
+
+def open_steam_pipe(ctx: Context) -> int | None:
+    # We run as root and the pipe lives in a user controlled directory.
+    # Do not follow symlinks, and only open a FIFO owned by the user, so
+    # the path can not be redirected to a device node or another FIFO.
+    dir_fd = None
+    fd = None
+    try:
+        dir_fd = os.open(
+            expanduser(STEAM_DIR, ctx), os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW
+        )
+        st = os.fstat(dir_fd)
+        if st.st_uid != ctx.euid:
+            return None
+
+        st = os.stat(STEAM_PIPE, dir_fd=dir_fd, follow_symlinks=False)
+        if not stat.S_ISFIFO(st.st_mode) or st.st_uid != ctx.euid:
+            return None
+
+        # Opening non-blocking fails with ENXIO if Steam is not listening.
+        fd = os.open(
+            STEAM_PIPE,
+            os.O_WRONLY | os.O_NONBLOCK | os.O_NOFOLLOW,
+            dir_fd=dir_fd,
+        )
+        # Make sure the pipe was not swapped after the check
+        fst = os.fstat(fd)
+        if (fst.st_dev, fst.st_ino) != (st.st_dev, st.st_ino):
+            return None
+
+        out = fd
+        fd = None
+        return out
+    except OSError:
+        return None
+    finally:
+        if fd is not None:
+            os.close(fd)
+        if dir_fd is not None:
+            os.close(dir_fd)
+
+
+def write_steam_pipe(command: str, ctx: Context):
+    # A running Steam client reads forwarded command lines from its pipe,
+    # which is what `steam -ifrunning` does after spawning the bootstrapper.
+    fd = open_steam_pipe(ctx)
+    if fd is None:
+        return False
+    try:
+        line = f'"{expanduser(STEAM_EXE, ctx)}" -ifrunning {command}\n'
+        os.write(fd, line.encode())
+        return True
+    except OSError as e:
+        logger.warning(f"Could not write to the steam pipe, falling back.\n{e}")
+        return False
+    finally:
+        os.close(fd)
+
+
+def open_steam_pidfd() -> int | None:
+    # Returns a pidfd that becomes readable when the Steam process found by
+    # the last `is_steam_gamescope_running` call exits.
+    pid = _steam_cache["pid"]
+    if not pid or not _steam_cache["answer"] or not hasattr(os, "pidfd_open"):
+        return None
+    try:
+        return os.pidfd_open(int(pid))
+    except Exception:
+        return None
 
 
 def run_steam_command(command: str, ctx: Context):
-    global home_path
+    if write_steam_pipe(command, ctx):
+        return True
+
     try:
         result = subprocess.run(
             [
@@ -63,15 +176,29 @@ def run_steam_command(command: str, ctx: Context):
     return False
 
 
-def register_power_button(b: PowerButtonConfig) -> evdev.InputDevice | None:
-    for device in [evdev.InputDevice(path) for path in evdev.list_devices()]:
-        if str(device.phys).startswith(b.phys):
-            device.grab()
-            logger.info(f"Captured power button '{device.name}': '{device.phys}'")
-            return device
+def find_device(phys: str) -> evdev.InputDevice | None:
+    # Match against sysfs so only the matching event node is opened
+    for name in sorted(os.listdir("/sys/class/input")):
+        if not name.startswith("event"):
+            continue
+        try:
+            with open(f"/sys/class/input/{name}/device/phys") as f:
+                dev_phys = f.read().strip()
+        except Exception:
+            continue
+        if dev_phys.startswith(phys):
+            return evdev.InputDevice(f"/dev/input/{name}")
     return None
 
 
+def register_power_button(b: PowerButtonConfig) -> evdev.InputDevice | None:
+    device = find_device(b.phys)
+    if device:
+        device.grab()
+        logger.info(f"Captured power button '{device.name}': '{device.phys}'")
+    return device
+
+
 def register_hold_button(b: PowerButtonConfig) -> evdev.InputDevice | None:
     if not b.hold_phys or not b.hold_events or b.hold_grab is None:
         logger.error(
@@ -79,24 +206,28 @@ def register_hold_button(b: PowerButtonConfig) -> evdev.InputDevice | None:
         )
         return None
 
-    for device in [evdev.InputDevice(path) for path in evdev.list_devices()]:
-        if str(device.phys).startswith(b.hold_phys):
-            if b.hold_grab:
-                device.grab()
-            logger.info(f"Captured hold keyboard '{device.name}': '{device.phys}'")
-            return device
-    return None
+    device = find_device(b.hold_phys)
+    if device:
+        if b.hold_grab:
+            device.grab()
+        logger.info(f"Captured hold keyboard '{device.name}': '{device.phys}'")
+    return device
 
 
-def get_config() -> PowerButtonConfig | None:
-    with open("/sys/devices/virtual/dmi/id/product_name") as f:
-        prod = f.read().strip()
+_PROD: str | None = None
 
-    for d in SUPPORTED_DEVICES:
-        if d.prod_name == prod:
-            return d
 
-    return None
+def get_product_name() -> str:
+    # The DMI product name can not change at runtime, read it once
+    global _PROD
+    if _PROD is None:
+        with open("/sys/devices/virtual/dmi/id/product_name") as f:
+            _PROD = f.read().strip()
+    return _PROD
+
+
+def get_config() -> PowerButtonConfig | None:
+    return _BY_PROD.get(get_product_name())
 
 
 def run_steam_shortpress(perms: Context):
@@ -128,14 +259,25 @@ def power_button_isa(cfg: PowerButtonConfig, perms: Context, should_exit: Event)
         logger.error(f"Invalid hold events in config. Exiting.\n:{cfg.hold_events}")
         return
 
+    # Compile the hold sequence into a transition table, any event that
+    # does not advance the sequence resets it.
+    hold_len = len(cfg.hold_events)
+    transitions = {(i, tuple(chk)): i + 1 for i, chk in enumerate(cfg.hold_events)}
+
     press_dev = None
     hold_dev = None
+    poll = None
+    steam_fd = None
     try:
         hold_state = 0
         while not should_exit.is_set():
-            # Initial check for steam
-            if not is_steam_gamescope_running(perms):
+            # Initial check for steam, skipped while the steam pidfd
+            # is watched since it will report steam exiting
+            if steam_fd is None and not is_steam_gamescope_running(perms):
                 # Close devices
+                if poll:
+                    poll.close()
+                    poll = None
                 if press_dev:
                     press_dev.close()
                     press_dev = None
@@ -155,37 +297,51 @@ def power_button_isa(cfg: PowerButtonConfig, perms: Context, should_exit: Event)
             if not press_dev or not hold_dev:
                 logger.error(f"Power button interfaces not found, disabling plugin.")
                 return
+            if not poll:
+                poll = select.epoll()
+                poll.register(press_dev.fd, select.EPOLLIN)
+                poll.register(hold_dev.fd, select.EPOLLIN)
+                steam_fd = open_steam_pidfd()
+                if steam_fd is not None:
+                    poll.register(steam_fd, select.EPOLLIN)
+
+            # Add timeout to check the exit flag and, without a pidfd,
+            # to release the button if steam exits.
+            r = poll.poll(STEAM_WAIT_DELAY)
 
-            # Add timeout to release the button if steam exits.
-            r = select.select([press_dev.fd, hold_dev.fd], [], [], STEAM_WAIT_DELAY)[0]
-            
             if not r:
                 continue
-            fd = r[0]  # handle one button at a time
+            if steam_fd is not None and any(fd == steam_fd for fd, _ in r):
+                # Steam exited, recheck it before handling buttons.
+                # Drop the cached answer, steam may not be reaped yet.
+                _steam_cache["pid"] = None
+                poll.close()
+                poll = None
+                os.close(steam_fd)
+                steam_fd = None
+                continue
 
-            # Handle button event
+            # Handle button events, draining all pending events of each
+            # device so a full hold sequence is matched in one wakeup
             issue_systemctl = False
-            if fd == press_dev.fd:
-                ev = press_dev.read_one()
-                if ev.type == B("EV_KEY") and ev.code == B("KEY_POWER") and ev.value:
-                    logger.info("Executing short press.")
-                    issue_systemctl = not run_steam_shortpress(perms)
-            elif fd == hold_dev.fd:
-                ev = hold_dev.read_one()
-                chk = (ev.type, ev.code, ev.value)
-
-                if hold_state >= len(cfg.hold_events):
-                    hold_state = 0
-
-                if chk == cfg.hold_events[hold_state]:
-                    hold_state += 1
-                else:
-                    hold_state = 0
-
-                if hold_state == len(cfg.hold_events):
-                    hold_state = 0
-                    logger.info("Executing long press.")
-                    issue_systemctl = not run_steam_longpress(perms)
+            for fd, _ in r:
+                if fd == press_dev.fd:
+                    for ev in press_dev.read():
+                        if ev.type == EV_KEY and ev.code == KEY_POWER and ev.value:
+                            logger.info("Executing short press.")
+                            issue_systemctl = not run_steam_shortpress(perms)
+                            break
+                elif fd == hold_dev.fd:
+                    for ev in hold_dev.read():
+                        hold_state = transitions.get(
+                            (hold_state, (ev.type, ev.code, ev.value)), 0
+                        )
+
+                        if hold_state == hold_len:
+                            hold_state = 0
+                            logger.info("Executing long press.")
+                            issue_systemctl = not run_steam_longpress(perms)
+                            break
 
             if issue_systemctl:
                 logger.error(
@@ -196,15 +352,22 @@ def power_button_isa(cfg: PowerButtonConfig, perms: Context, should_exit: Event)
         pass
     except Exception as e:
         logger.error(f"Received exception, exitting:\n{e}")
+    finally:
+        if poll:
+            poll.close()
+        if steam_fd is not None:
+            os.close(steam_fd)
 
 
 def power_button_timer(cfg: PowerButtonConfig, perms: Context, should_exit: Event):
     dev = None
+    steam_fd = None
     try:
         pressed_time = None
         while not should_exit.is_set():
-            # Initial check for steam
-            if not is_steam_gamescope_running(perms):
+            # Initial check for steam, skipped while the steam pidfd
+            # is watched since it will report steam exiting
+            if steam_fd is None and not is_steam_gamescope_running(perms):
                 # Close devices
                 if dev:
                     dev.close()
@@ -219,50 +382,59 @@ def power_button_timer(cfg: PowerButtonConfig, perms: Context, should_exit: Even
             if not dev:
                 logger.error(f"Power button not found, disabling plugin.")
                 return
+            if steam_fd is None:
+                steam_fd = open_steam_pidfd()
 
-            # Add timeout to release the button if steam exits.
+            # Add timeout to check the exit flag and, without a pidfd,
+            # to release the button if steam exits.
             delay = LONG_PRESS_DELAY if pressed_time else STEAM_WAIT_DELAY
-            r = select.select([dev.fd], [], [], delay)[0]
+            fds = [dev.fd] if steam_fd is None else [dev.fd, steam_fd]
+            r = select.select(fds, [], [], delay)[0]
+            if steam_fd is not None and steam_fd in r:
+                # Steam exited, recheck it before handling buttons.
+                # Drop the cached answer, steam may not be reaped yet.
+                _steam_cache["pid"] = None
+                os.close(steam_fd)
+                steam_fd = None
+                continue
 
             # Handle press logic
+            press_types = []
             if r:
-                # Handle button event
-                ev = dev.read_one()
-                if ev.type == B("EV_KEY") and ev.code == B("KEY_POWER"):
+                # Handle all pending button events
+                for ev in dev.read():
+                    if ev.type != EV_KEY or ev.code != KEY_POWER:
+                        continue
                     curr_time = perf_counter()
                     if ev.value:
                         pressed_time = curr_time
-                        press_type = "initial_press"
+                        press_types.append("initial_press")
                     elif pressed_time:
                         if curr_time - pressed_time > LONG_PRESS_DELAY:
-                            press_type = "long_press"
+                            press_types.append("long_press")
                         else:
-                            press_type = "short_press"
+                            press_types.append("short_press")
                         pressed_time = None
                     else:
-                        press_type = "release_without_press"
-                else:
-                    press_type = "no_press"
+                        press_types.append("release_without_press")
             elif pressed_time:
                 # Button was pressed but we hit a timeout, that means
                 # it is a long press
-                press_type = "long_press"
-            else:
-                # Otherwise, no press
-                press_type = "no_press"
+                press_types.append("long_press")
 
             issue_systemctl = False
-            match press_type:
-                case "long_press":
-                    logger.info("Executing long press.")
-                    issue_systemctl = not run_steam_longpress(perms)
-                case "short_press":
-                    logger.info("Executing short press.")
-                    issue_systemctl = not run_steam_shortpress(perms)
-                case "initial_press":
-                    logger.info("Power button pressed down.")
-                case "release_without_press":
-                    logger.error("Button released without being pressed.")
+            for press_type in press_types:
+                match press_type:
+                    case "long_press":
+                        logger.info("Executing long press.")
+                        issue_systemctl |= not run_steam_longpress(perms)
+                    case "short_press":
+                        logger.info("Executing short press.")
+                        issue_systemctl |= not run_steam_shortpress(perms)
+                    case "initial_press":
+                        logger.info("Power button pressed down.")
+                    case "release_without_press":
+                        logger.error("Button released without being pressed.")
 
             if issue_systemctl:
                 logger.error(
@@ -276,3 +448,5 @@ def power_button_timer(cfg: PowerButtonConfig, perms: Context, should_exit: Even
     finally:
         if dev:
             dev.close()
+        if steam_fd is not None:
+            os.close(steam_fd)